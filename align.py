@@ -0,0 +1,29 @@
+import cv2
+import numpy as np
+import torch
+from torch import nn
+
+def rescale_landmarks(landmarks, src_shape, dst_shape):
+    # landmarks found on an image of src_shape (H, W, ...) to the pixel coordinates of the same
+    # image resized uniformly to dst_shape, with the pixel center convention of cv2.resize
+    scale = min(dst_shape[:2]) / min(src_shape[:2])
+    return (np.asarray(landmarks, dtype=np.float64) + 0.5) * scale - 0.5
+
+def warp_faces(images, landmarks, face_template, face_size, border_value=(132, 133, 135)):
+    # batched equivalent of FaceRestoreHelper.align_warp_face on an RGB IMAGE tensor [N, H, W, C],
+    # sampled with the cv2.warpAffine pixel convention and returned as [N, C, h, w]
+    affine_matrices = [cv2.estimateAffinePartial2D(landmark, face_template, method=cv2.LMEDS)[0] for landmark in landmarks]
+    inverse = np.stack([cv2.invertAffineTransform(affine_matrix) for affine_matrix in affine_matrices])
+    inverse = torch.from_numpy(inverse).to(images.device, dtype=torch.float32)
+
+    n, h, w, _ = images.shape
+    out_w, out_h = face_size
+    ys, xs = torch.meshgrid(torch.arange(out_h, device=images.device), torch.arange(out_w, device=images.device), indexing="ij")
+    dst = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).reshape(1, -1, 3).to(torch.float32)
+    src = dst @ inverse.transpose(1, 2)
+    grid = torch.stack([(2 * src[..., 0] + 1) / w - 1, (2 * src[..., 1] + 1) / h - 1], dim=-1).reshape(n, out_h, out_w, 2)
+
+    # sampling (image - border) with zero padding gives the constant border of cv2
+    border = torch.tensor(border_value, device=images.device, dtype=torch.float32).view(1, -1, 1, 1) / 255.
+    faces = nn.functional.grid_sample(images.permute(0, 3, 1, 2).to(torch.float32) - border, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+    return (faces + border).clamp(0, 1)
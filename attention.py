@@ -0,0 +1,74 @@
+import torch
+
+def id_attention(q, k, v, heads, mass_tokens=0, num_zero=0):
+    # attention over the few ID tokens with explicit probabilities, q/k/v are [B, N, C].
+    # With mass_tokens > 0 it also returns the softmax mass of the first mass_tokens keys
+    # under the full-width q @ k^T logits, averaged over the queries ([B, 1, 1], float32).
+    # Those logits are the per-head logits summed over the heads, so no second map is needed.
+    # num_zero stands for that many extra all-zero keys/values: they have a logit of 0 and add
+    # nothing to the output, so they only add num_zero * exp(0) to every softmax denominator.
+    out, mass = stacked_id_attention(q, [k], [v], heads, mass_tokens, [num_zero])
+    return out[0], mass[0] if mass is not None else None
+
+def softmax_with_zeros(logits, num_zero):
+    # softmax over the last axis of [..., groups, tokens] logits as if num_zero[g] extra keys
+    # with a logit of 0 were appended to group g, computed in float32 through the logsumexp
+    log_zero = torch.tensor(num_zero, dtype=torch.float32, device=logits.device).log().unsqueeze(-1)
+    lse = torch.logaddexp(torch.logsumexp(logits.float(), dim=-1, keepdim=True), log_zero)
+    return (logits.float() - lse).exp()
+
+def stacked_id_attention(q, ks, vs, heads, mass_tokens=0, num_zero=None):
+    # id_attention for several adapters sharing the same q in one launch. The keys of every
+    # adapter form a group along the key axis, padded to the longest group and masked, and each
+    # group keeps its own softmax, with num_zero[g] implicit zero keys. Returns the list of
+    # outputs and the list of masses.
+    b, n, c = q.shape
+    dim_head = c // heads
+    groups = len(ks)
+    tokens = max(k.shape[1] for k in ks)
+
+    bias = None
+    if any(k.shape[1] != tokens for k in ks):
+        pad = lambda x: torch.nn.functional.pad(x, (0, 0, 0, tokens - x.shape[1]))
+        bias = torch.zeros((groups, tokens), dtype=q.dtype, device=q.device)
+        for i, k in enumerate(ks):
+            bias[i, k.shape[1]:] = float("-inf")
+        ks = [pad(k) for k in ks]
+        vs = [pad(v) for v in vs]
+    k = torch.stack(ks, dim=1) if groups > 1 else ks[0]
+    v = torch.stack(vs, dim=1) if groups > 1 else vs[0]
+
+    q = q.view(b, n, heads, dim_head).transpose(1, 2)
+    k = k.reshape(b, groups * tokens, heads, dim_head).permute(0, 2, 3, 1)
+    v = v.reshape(b, groups, tokens, heads, dim_head).permute(0, 3, 1, 2, 4)
+
+    logits = (q @ k).view(b, heads, n, groups, tokens)
+    if bias is not None:
+        logits = logits + bias
+    if not any(num_zero or []):
+        num_zero = None
+    if num_zero is None:
+        probs = (logits * dim_head ** -0.5).softmax(dim=-1)
+    else:
+        probs = softmax_with_zeros(logits * dim_head ** -0.5, num_zero).to(dtype=v.dtype)
+    out = probs.transpose(2, 3) @ v
+    out = out.permute(2, 0, 3, 1, 4).reshape(groups, b, n, c)
+
+    if mass_tokens == 0:
+        return list(out), None
+
+    mass = logits.sum(dim=1, dtype=torch.float32)
+    mass = mass.softmax(dim=-1) if num_zero is None else softmax_with_zeros(mass, num_zero)
+    mass = mass[..., :mass_tokens].sum(dim=-1).mean(dim=1)
+    return list(out), [mass[:, i].view(b, 1, 1) for i in range(groups)]
+
+def orthogonal_projection(out, out_ip, weight=1.0, scale=None):
+    # weight * (out_ip + (scale - 1) * proj), proj being out_ip projected on out per channel
+    # over the token axis. scale=None drops the whole projection (ortho), ortho_v2 passes the
+    # ID-token attention mass. The token-axis dot products accumulate in float32 while the
+    # activations are read and written in their own dtype, without full-size float32 copies.
+    dot = (out * out_ip).sum(dim=-2, keepdim=True, dtype=torch.float32)
+    norm = (out * out).sum(dim=-2, keepdim=True, dtype=torch.float32)
+    coef = dot / norm
+    coef = -coef if scale is None else (scale - 1) * coef
+    return torch.addcmul(out_ip, out, coef.to(dtype=out.dtype)).mul_(weight)
@@ -0,0 +1,76 @@
+# Checks that the EVA-CLIP crop of a reference smaller than 512px matches the crop of the original
+# FaceRestoreHelper path, which warped the upscaled face_helper.input_img with the landmarks found on it,
+# for the RetinaFace landmarks (found on input_img) and the insightface kps (found on the reference).
+#   python benchmarks/alignment_small_reference.py [--size 384]
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from align import rescale_landmarks, warp_faces
+
+# FFHQ 5 point template of ModifiedFaceRestoreHelper at face_size 512
+FACE_TEMPLATE = np.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935], [201.26117, 371.41043], [313.08905, 371.15118]])
+FACE_SIZE = (512, 512)
+BORDER = (132, 133, 135)
+
+def read_image(img):
+    # the upscaling of FaceRestoreHelper.read_image
+    if min(img.shape[:2]) < 512:
+        f = 512.0 / min(img.shape[:2])
+        img = cv2.resize(img, (0, 0), fx=f, fy=f, interpolation=cv2.INTER_LINEAR)
+    return img
+
+def align_warp_face(input_img, landmark):
+    affine_matrix = cv2.estimateAffinePartial2D(landmark, FACE_TEMPLATE, method=cv2.LMEDS)[0]
+    return cv2.warpAffine(input_img, affine_matrix, FACE_SIZE, borderMode=cv2.BORDER_CONSTANT, borderValue=tuple(b / 255. for b in BORDER))
+
+def warp(image, landmark):
+    face = warp_faces(torch.from_numpy(image)[None], [landmark], FACE_TEMPLATE, FACE_SIZE)
+    return face[0].permute(1, 2, 0).numpy()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=384, help="short side of the synthetic reference")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="max mean absolute difference")
+    args = parser.parse_args()
+
+    # smooth synthetic reference, so a misplaced crop shows up as a large difference
+    rng = np.random.default_rng(0)
+    h, w = args.size, args.size * 4 // 3
+    image = cv2.GaussianBlur(rng.random((h, w, 3)).astype(np.float32), (0, 0), 4)
+    image = (image - image.min()) / (image.max() - image.min())
+    face = FACE_TEMPLATE * (0.35 * h / 512) + np.array([0.3 * w, 0.2 * h])
+
+    input_img = read_image(image)
+    # RetinaFace runs on input_img, its landmarks are in the upscaled coordinates
+    retinaface = rescale_landmarks(face, image.shape, input_img.shape)
+    reference = align_warp_face(input_img, retinaface)
+
+    # insightface runs on the reference itself, so its kps are in the original coordinates
+    insightface = face
+
+    # (name, crop, whether it must match the reference crop)
+    cases = [
+        ("retinaface", warp(image, rescale_landmarks(retinaface, input_img.shape, image.shape)), True),
+        ("insightface", warp(image, insightface), True),
+    ]
+    if input_img.shape != image.shape:
+        # landmarks used in the frame of the other image must give a different crop
+        cases.append(("retinaface unscaled", warp(image, retinaface), False))
+        cases.append(("kps on input_img", align_warp_face(input_img, insightface), False))
+
+    failed = False
+    for name, crop, expected in cases:
+        error = np.abs(crop - reference).mean()
+        ok = (error < args.tolerance) == expected
+        failed |= not ok
+        print(f"{name:>20}: mean abs difference {error:.4f} {'ok' if ok else 'FAILED'}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
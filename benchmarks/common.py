@@ -0,0 +1,21 @@
+# Helpers shared by the benchmark scripts, which run as `python benchmarks/<script>.py`.
+import time
+
+import torch
+
+def measure(fn, args, device, repeat, warmup=1):
+    # (result, milliseconds per call, peak MiB allocated on top of what was allocated before, NaN off cuda)
+    for _ in range(warmup):
+        fn(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    peak = (torch.cuda.max_memory_allocated() - base) / 2**20 if device.type == "cuda" else float("nan")
+    return result, elapsed, peak
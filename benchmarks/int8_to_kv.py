@@ -0,0 +1,48 @@
+# Accuracy and memory of the int8 To_KV storage on synthetic SDXL-shaped weights.
+#   python benchmarks/int8_to_kv.py [--device cuda] [--dtype float16]
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from encoders import To_KV, quantize_int8
+
+def sdxl_state_dict(std):
+    # to_k_ip/to_v_ip of the 70 patched layers, 640 wide in input 4-5 / output 3-5, else 1280
+    widths = [640] * 4 + [1280] * 20 + [1280] * 30 + [640] * 6 + [1280] * 10
+    state_dict = {}
+    for number, width in enumerate(widths):
+        for name in ("to_k_ip", "to_v_ip"):
+            state_dict[f"{number * 2 + 1}.{name}.weight"] = torch.randn(width, 2048) * std
+    return state_dict
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--tokens", type=int, default=26)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    dtype = getattr(torch, args.dtype)
+    state_dict = sdxl_state_dict(std=0.02)
+    module_keys = [str(number * 2 + 1) for number in range(70)]
+    embeds = torch.randn(2, args.tokens, 2048, device=args.device)
+
+    reference = To_KV(state_dict).to(args.device)(embeds, module_keys)
+    default = To_KV({k: v.to(dtype) for k, v in state_dict.items()}).to(args.device, dtype=dtype)
+    int8 = To_KV(quantize_int8({k: v.to(dtype) for k, v in state_dict.items()})).to(args.device, dtype=dtype)
+
+    for name, to_kv in [(args.dtype, default), ("int8", int8)]:
+        size = sum(t.nbytes for t in to_kv.state_dict().values()) / 2**20
+        kv = to_kv(embeds.to(dtype), module_keys)
+        errors = []
+        for module_key in module_keys:
+            for ref, res in zip(reference[module_key], kv[module_key]):
+                errors.append(((res.float() - ref).norm() / ref.norm()).item())
+        print(f"{name:>9}: {size:8.1f} MiB, relative error mean {sum(errors) / len(errors):.2e} max {max(errors):.2e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Speed and peak memory of attention.orthogonal_projection against the float32 code it replaced.
+#   python benchmarks/ortho_projection.py [--device cuda] [--dtype float16] [--compile]
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attention import orthogonal_projection
+from common import measure
+
+def reference_projection(out, out_ip, weight=1.0, scale=None):
+    # the ortho / ortho_v2 code of pulid_attention before the fused routine
+    out = out.to(dtype=torch.float32)
+    out_ip = out_ip.to(dtype=torch.float32)
+    projection = (torch.sum((out * out_ip), dim=-2, keepdim=True) / torch.sum((out * out), dim=-2, keepdim=True) * out)
+    if scale is None:
+        orthogonal = out_ip - projection
+    else:
+        orthogonal = out_ip + (scale - 1) * projection
+    return weight * orthogonal
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--compile", action="store_true")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    fused = torch.compile(orthogonal_projection) if args.compile else orthogonal_projection
+
+    # SDXL attention shapes at 1024x1024: 64x64 tokens at 640 channels, 32x32 at 1280
+    print(f"{'tokens':>7} {'dim':>5} {'mode':>8} {'ref ms':>8} {'fused ms':>9} {'ref MiB':>8} {'fused MiB':>10} {'max err':>9}")
+    for tokens, dim in [(4096, 640), (1024, 1280), (9216, 640), (2304, 1280)]:
+        out = torch.randn(args.batch, tokens, dim, device=device).to(dtype)
+        out_ip = torch.randn(args.batch, tokens, dim, device=device).to(dtype)
+        mass = torch.rand(args.batch, 1, 1, device=device)
+        for mode, scale in [("ortho", None), ("ortho_v2", mass)]:
+            ref, ref_ms, ref_mb = measure(reference_projection, (out, out_ip, 1.0, scale), device, args.repeat, warmup=3)
+            res, fused_ms, fused_mb = measure(fused, (out, out_ip, 1.0, scale), device, args.repeat, warmup=3)
+            err = (res.float() - ref).abs().max().item()
+            print(f"{tokens:>7} {dim:>5} {mode:>8} {ref_ms:>8.3f} {fused_ms:>9.3f} {ref_mb:>8.1f} {fused_mb:>10.1f} {err:>9.2e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Per-call time of attention.id_attention (batched matmul + softmax) against PyTorch SDPA, which is
+# what optimized_attention runs with --use-pytorch-cross-attention, over the ID branch shapes.
+# Prints, for every width and ID token count, the largest query count where id_attention wins.
+#   python benchmarks/small_key_attention.py [--device cuda] [--dtype float16]
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attention import id_attention
+from common import measure
+
+def sdpa_attention(q, k, v, heads):
+    # optimized_attention_pytorch of comfy.ldm.modules.attention
+    b, _, dim_head = q.shape
+    dim_head //= heads
+    q, k, v = map(lambda t: t.view(b, -1, heads, dim_head).transpose(1, 2), (q, k, v))
+    out = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+    return out.transpose(1, 2).reshape(b, -1, heads * dim_head)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16" if torch.cuda.is_available() else "float32", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    print(f"{'dim':>5} {'keys':>5} {'queries':>8} {'manual ms':>10} {'sdpa ms':>8} {'max err':>9}")
+    for dim in (640, 1280):
+        heads = dim // 64
+        for keys in (32, 40, 48):
+            threshold = 0
+            for tokens in (64, 256, 1024, 4096, 9216, 16384):
+                q = torch.randn(args.batch, tokens, dim, device=device, dtype=dtype)
+                k = torch.randn(args.batch, keys, dim, device=device, dtype=dtype)
+                v = torch.randn(args.batch, keys, dim, device=device, dtype=dtype)
+                _, manual_ms, _ = measure(lambda *a: id_attention(*a)[0], (q, k, v, heads), device, args.repeat)
+                _, sdpa_ms, _ = measure(sdpa_attention, (q, k, v, heads), device, args.repeat)
+                err = (id_attention(q, k, v, heads)[0].float() - sdpa_attention(q, k, v, heads).float()).abs().max().item()
+                if manual_ms < sdpa_ms:
+                    threshold = tokens
+                print(f"{dim:>5} {keys:>5} {tokens:>8} {manual_ms:>10.3f} {sdpa_ms:>8.3f} {err:>9.2e}")
+            print(f"{dim:>5} {keys:>5} id_attention wins up to {threshold} queries")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# The ID attention of style (16 zero tokens) and fidelity (8) before and after the zero tokens were
+# handled analytically: SDPA over the ID keys with the zero keys concatenated (before, the only path),
+# attention.id_attention with num_zero and SDPA over one zero key biased by log(num_zero). Since then
+# small_key_attention times all three on the first call of a shape and keeps the fastest.
+#   python benchmarks/zero_tokens.py [--device cuda] [--dtype float16]
+import argparse
+import math
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attention import id_attention
+from common import measure
+
+def sdpa_attention(q, k, v, heads, mask=None):
+    # optimized_attention_pytorch of comfy.ldm.modules.attention
+    b, _, dim_head = q.shape
+    dim_head //= heads
+    q, k, v = map(lambda t: t.view(b, -1, heads, dim_head).transpose(1, 2), (q, k, v))
+    if mask is not None and mask.ndim == 2:
+        mask = mask.unsqueeze(0)
+    out = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    return out.transpose(1, 2).reshape(b, -1, heads * dim_head)
+
+def concatenated_zeros(q, k, v, heads, num_zero):
+    zeros = k.new_zeros((k.shape[0], num_zero, k.shape[2]))
+    return sdpa_attention(q, torch.cat([k, zeros], dim=1), torch.cat([v, zeros], dim=1), heads)
+
+def biased_zero_token(q, k, v, heads, num_zero, bias):
+    zero = k.new_zeros((k.shape[0], 1, k.shape[2]))
+    return sdpa_attention(q, torch.cat([k, zero], dim=1), torch.cat([v, zero], dim=1), heads, mask=bias)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16" if torch.cuda.is_available() else "float32", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--keys", type=int, default=10, help="ID tokens of the IDEncoder")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    print(f"{'queries':>8} {'dim':>5} {'zeros':>5} {'concat ms':>10} {'analytic ms':>12} {'biased ms':>10} {'analytic err':>13} {'biased err':>11}")
+    for tokens, dim in [(4096, 640), (1024, 1280), (16384, 640), (4096, 1280)]:
+        heads = dim // 64
+        q = torch.randn(args.batch, tokens, dim, device=device, dtype=dtype)
+        k = torch.randn(args.batch, args.keys, dim, device=device, dtype=dtype)
+        v = torch.randn(args.batch, args.keys, dim, device=device, dtype=dtype)
+        for num_zero in (16, 8):
+            bias = torch.zeros((1, args.keys + 1), device=device, dtype=dtype)
+            bias[0, -1] = math.log(num_zero)
+            ref, concat_ms, _ = measure(concatenated_zeros, (q, k, v, heads, num_zero), device, args.repeat)
+            analytic, analytic_ms, _ = measure(lambda *a: id_attention(*a, num_zero=num_zero)[0], (q, k, v, heads), device, args.repeat)
+            biased, biased_ms, _ = measure(biased_zero_token, (q, k, v, heads, num_zero, bias), device, args.repeat)
+            analytic_err = (analytic.float() - ref.float()).abs().max().item()
+            biased_err = (biased.float() - ref.float()).abs().max().item()
+            print(f"{tokens:>8} {dim:>5} {num_zero:>5} {concat_ms:>10.3f} {analytic_ms:>12.3f} {biased_ms:>10.3f} {analytic_err:>13.2e} {biased_err:>11.2e}")
+
+if __name__ == "__main__":
+    main()
@@ -61,3 +61,61 @@ class IDEncoder(nn.Module):
         hidden_states = torch.cat(hidden_states, dim=1)
 
         return torch.cat([x, hidden_states], dim=1)
+
+
+# output rows dequantized at once by To_KV when its weight is int8
+DEQUANT_ROWS = 16384
+
+def quantize_int8(state_dict):
+    # symmetric int8 with one float32 scale per output channel, "x.weight" -> "x.weight" + "x.scale"
+    quantized = {}
+    for key, value in state_dict.items():
+        value = value.float()
+        scale = value.abs().amax(dim=1).clamp(min=1e-8) / 127
+        quantized[key] = torch.round(value / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        quantized[key.replace(".weight", ".scale")] = scale
+    return quantized
+
+class To_KV(nn.Module):
+    def __init__(self, state_dict):
+        super().__init__()
+
+        # the bias-free to_k_ip/to_v_ip projections of every layer, stacked into one weight
+        self.slices = {}
+        weights = []
+        scales = []
+        start = 0
+        for key, value in state_dict.items():
+            if not key.endswith(".weight"):
+                continue
+            self.slices[key.replace(".weight", "").replace(".", "_")] = (start, start + value.shape[0])
+            start += value.shape[0]
+            weights.append(value)
+            if value.dtype == torch.int8:
+                scales.append(state_dict[key.replace(".weight", ".scale")])
+
+        if scales:
+            # int8 weights are buffers, so moving the module to a float dtype leaves them int8
+            self.register_buffer("weight", torch.cat(weights))
+            self.register_buffer("scale", torch.cat(scales))
+        else:
+            self.weight = nn.Parameter(torch.cat(weights), requires_grad=False)
+            self.scale = None
+
+    def forward(self, embeds, module_keys):
+        # project the embeddings for all the layers in a single matmul, then split per module_key
+        if self.scale is None:
+            kv = embeds @ self.weight.t()
+        else:
+            # dequantize a slice of rows at a time, accumulating in float32
+            kv = torch.cat([
+                (embeds.float() @ weight.float().t()) * scale.float()
+                for weight, scale in zip(self.weight.split(DEQUANT_ROWS), self.scale.split(DEQUANT_ROWS))
+            ], dim=-1).to(dtype=embeds.dtype)
+
+        ip_kv = {}
+        for module_key in module_keys:
+            k_start, k_end = self.slices[module_key + "_to_k_ip"]
+            v_start, v_end = self.slices[module_key + "_to_v_ip"]
+            ip_kv[module_key] = (kv[..., k_start:k_end].contiguous(), kv[..., v_start:v_end].contiguous())
+        return ip_kv
@@ -2,9 +2,15 @@ import torch
 from torch import nn
 import torchvision.transforms as T
 import os
+import hashlib
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import folder_paths
 import comfy.utils
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
 import numpy as np
 from copy import deepcopy
 from codeformer.facelib.parsing.bisenet import BiSeNet
@@ -78,57 +84,63 @@ class ModifiedFaceRestoreHelper(FaceRestoreHelper):
         else:
             self.device = device
 
-        # init face detection model
-        def init_retinaface_model(dir_path,model_name, half=False, device='cuda'):
-
-            model = RetinaFace(network_name='mobile0.25', half=half)
-            model_path=os.path.join(dir_path,"detection_mobilenet0.25_Final.pth")
-          
-            load_net = torch.load(model_path, map_location=lambda storage, loc: storage)
-            # remove unnecessary 'module.'
-            for k, v in deepcopy(load_net).items():
-                if k.startswith('module.'):
-                    load_net[k[7:]] = v
-                    load_net.pop(k)
-            model.load_state_dict(load_net, strict=True)
-            model.eval()
-            model = model.to(device)
-
-            return model
-
-        
-        self.face_detector = init_retinaface_model(dirpath,model_name, half=False, device=self.device)
-                
-        def init_parsing_model(dir_path,model_name='bisenet', half=False, device='cuda'):
-            if model_name == 'bisenet':
-                model = BiSeNet(num_class=19)
-                model_path=os.path.join(dir_path,'parsing_bisenet.pth')
-                model_url = 'https://github.com/sczhou/CodeFormer/releases/download/v0.1.0/parsing_bisenet.pth'
-            elif model_name == 'parsenet':
-                model = ParseNet(in_size=512, out_size=512, parsing_ch=19)
-                model_path=os.path.join(dir_path,'parsing_parsenet.pth')
-                model_url = 'https://github.com/sczhou/CodeFormer/releases/download/v0.1.0/parsing_parsenet.pth'
-            else:
-                raise NotImplementedError(f'{model_name} is not implemented.')
-
-            # model_path = load_file_from_url(url=model_url, model_dir='weights/facelib', progress=True, file_name=None)
-            load_net = torch.load(model_path, map_location=lambda storage, loc: storage)
-            model.load_state_dict(load_net, strict=True)
-            model.eval()
-            model = model.to(device)
-            return model
+        # init face detection model on first use, nets are shared across helpers
+        self.face_detector_path = os.path.join(dirpath, "detection_mobilenet0.25_Final.pth")
 
         # init face parsing model
         self.use_parse = use_parse
-        self.face_parse = init_parsing_model(dirpath,model_name='bisenet', device=self.device)
+        self.face_parse = load_face_model(os.path.join(dirpath, "parsing_bisenet.pth"), init_parsing_model, self.device)
+
+    @property
+    def face_detector(self):
+        # not needed when the faces are aligned on the insightface keypoints
+        return load_face_model(self.face_detector_path, init_retinaface_model, self.device)
+
+# detection and parsing nets are loaded once per process and reused by every helper
+face_models = {}
+
+def load_face_model(model_path, init_model, device, dtype=torch.float32):
+    key = (os.path.abspath(model_path), str(device), dtype)
+    if key not in face_models:
+        face_models[key] = init_model(model_path).to(device, dtype=dtype)
+    return face_models[key]
+
+def init_retinaface_model(model_path, half=False):
+    model = RetinaFace(network_name='mobile0.25', half=half)
+
+    load_net = torch.load(model_path, map_location=lambda storage, loc: storage)
+    # remove unnecessary 'module.'
+    for k, v in deepcopy(load_net).items():
+        if k.startswith('module.'):
+            load_net[k[7:]] = v
+            load_net.pop(k)
+    model.load_state_dict(load_net, strict=True)
+    model.eval()
+
+    return model
+
+def init_parsing_model(model_path, model_name='bisenet'):
+    if model_name == 'bisenet':
+        model = BiSeNet(num_class=19)
+        # model_url = 'https://github.com/sczhou/CodeFormer/releases/download/v0.1.0/parsing_bisenet.pth'
+    else:
+        raise NotImplementedError(f'{model_name} is not implemented.')
+
+    load_net = torch.load(model_path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(load_net, strict=True)
+    model.eval()
+    return model
 
 
 
 from comfy.ldm.modules.attention import optimized_attention
+from safetensors.torch import load_file, save_file
 
 from .eva_clip.constants import OPENAI_DATASET_MEAN, OPENAI_DATASET_STD
 
-from .encoders import IDEncoder
+from .encoders import IDEncoder, To_KV, quantize_int8
+from .align import warp_faces, rescale_landmarks
+from .attention import id_attention, stacked_id_attention, orthogonal_projection
 
 INSIGHTFACE_DIR = os.path.join(folder_paths.models_dir, "insightface")
 
@@ -139,13 +151,105 @@ else:
     current_paths, _ = folder_paths.folder_names_and_paths["pulid"]
 folder_paths.folder_names_and_paths["pulid"] = (current_paths, folder_paths.supported_pt_extensions)
 
+# cond/uncond embeddings keyed by reference images, pulid checkpoint and dtype
+EMBEDS_CACHE_DIR = os.path.join(folder_paths.models_dir, "pulid_embeds")
+EMBEDS_CACHE_SIZE = 512
+# files kept in EMBEDS_CACHE_DIR, the least recently used are deleted beyond it
+EMBEDS_CACHE_DISK_SIZE = 2048
+# part of every cache key, bump it whenever a change to the face pipeline (detection,
+# alignment, crop, parsing, encoders) changes the embeddings so older files are not reused
+EMBEDS_PIPELINE_VERSION = 2
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return hashlib.sha256(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+def image_fingerprint(image):
+    h = hashlib.sha256(str(tuple(image.shape)).encode())
+    for i in range(image.shape[0]):
+        h.update(image[i].detach().cpu().contiguous().numpy())
+    return h.hexdigest()
+
+class EmbedsCache:
+    def __init__(self, cache_dir, max_size=EMBEDS_CACHE_SIZE, max_files=EMBEDS_CACHE_DISK_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_files = max_files
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def make_key(*parts):
+        parts = (EMBEDS_PIPELINE_VERSION,) + parts
+        return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".safetensors")
+
+    def remember(self, key, embeds):
+        self.entries[key] = embeds
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            tensors = load_file(path)
+        except Exception as e:
+            logging.warning(f"pulid: ignoring unreadable embeds cache file {path}: {e}")
+            return None
+        embeds = (tensors["cond"], tensors["uncond"])
+        self.remember(key, embeds)
+        try:
+            # the file modification time is the last use for prune()
+            os.utime(path)
+        except OSError:
+            pass
+        return embeds
+
+    def put(self, key, cond, uncond):
+        embeds = (cond.detach().cpu().contiguous(), uncond.detach().cpu().contiguous())
+        self.remember(key, embeds)
+
+        path = self.path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            save_file({"cond": embeds[0], "uncond": embeds[1]}, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning(f"pulid: could not write embeds cache file {path}: {e}")
+        self.prune()
+
+    def prune(self):
+        # delete the least recently used files beyond max_files
+        try:
+            files = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".safetensors")]
+            if len(files) <= self.max_files:
+                return
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[:len(files) - self.max_files]:
+                os.remove(entry.path)
+        except OSError as e:
+            logging.warning(f"pulid: could not prune the embeds cache directory {self.cache_dir}: {e}")
+
+embeds_cache = EmbedsCache(EMBEDS_CACHE_DIR)
+
 class PulidModel(nn.Module):
-    def __init__(self, model):
+    def __init__(self, model, id_encoder=True):
         super().__init__()
 
         self.model = model
-        self.image_proj_model = self.init_id_adapter()
-        self.image_proj_model.load_state_dict(model["image_proj"])
+        # the ID encoder is only needed when the embeddings aren't cached
+        self.image_proj_model = None
+        if id_encoder:
+            self.image_proj_model = self.init_id_adapter()
+            self.image_proj_model.load_state_dict(model["image_proj"])
         self.ip_layers = To_KV(model["ip_adapter"])
     
     def init_id_adapter(self):
@@ -156,25 +260,61 @@ class PulidModel(nn.Module):
         embeds = self.image_proj_model(face_embed, clip_embeds)
         return embeds
 
-class To_KV(nn.Module):
-    def __init__(self, state_dict):
-        super().__init__()
+    def get_uncond_embeds(self, face_embed, clip_embeds):
+        # the encoded zero input only depends on the weights, compute it once per loaded model
+        uncond_embeds = self.model.setdefault("uncond_embeds", {})
+        key = (str(face_embed.device), face_embed.dtype)
+        if key not in uncond_embeds:
+            uncond_embeds[key] = self.get_image_embeds(torch.zeros_like(face_embed[:1]), [torch.zeros_like(emb[:1]) for emb in clip_embeds])
+        return uncond_embeds[key]
+
+# det sizes tried by the insightface detector, largest first
+DET_SIZES = list(range(640, 256, -64))
+
+def det_size_order(image):
+    # start from the det size closest to the image resolution, upsampling a small image
+    # only makes the face too large for the detector anchors
+    long_side = max(image.shape[:2])
+    first = min(DET_SIZES, key=lambda size: abs(size - long_side))
+    return [first] + [size for size in DET_SIZES if size != first]
+
+def detect_face(face_analysis, image):
+    # retry with the detector alone and run recognition only on the selected face,
+    # face_analysis.get() would run every model on every face at every size
+    for size in det_size_order(image):
+        bboxes, kpss = face_analysis.det_model.detect(image, input_size=(size, size), max_num=0)
+        if bboxes.shape[0] > 0:
+            break
+    else:
+        return None, None
+
+    # keep the smallest detected face
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    i = int(areas.argmin())
+    face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+    face_analysis.models["recognition"].get(image, face)
+
+    return face, size
+
+def detect_face_image(face_analysis, image):
+    # converts a single IMAGE frame, the batch is never held as numpy at once
+    image = tensor_to_image(image)
+    face, det_size = detect_face(face_analysis, image)
+    return face, det_size, image
 
-        self.to_kvs = nn.ModuleDict()
-        for key, value in state_dict.items():
-            self.to_kvs[key.replace(".weight", "").replace(".", "_")] = nn.Linear(value.shape[1], value.shape[0], bias=False)
-            self.to_kvs[key.replace(".weight", "").replace(".", "_")].weight.data = value
+# rough peak memory to align, parse and encode one reference face, sizes the micro-batches
+FACE_ENCODE_MEMORY = 256 * 1024 * 1024
+FACE_ENCODE_MAX_BATCH = 32
+
+def encode_batch_size(device):
+    free_memory = comfy.model_management.get_free_memory(device)
+    return max(1, min(FACE_ENCODE_MAX_BATCH, int(free_memory // FACE_ENCODE_MEMORY)))
 
 def tensor_to_image(tensor):
     image = tensor.mul(255).clamp(0, 255).byte().cpu()
     image = image[..., [2, 1, 0]].numpy()
     return image
 
-def image_to_tensor(image):
-    tensor = torch.clamp(torch.from_numpy(image).float() / 255., 0, 1)
-    tensor = tensor[..., [2, 1, 0]]
-    return tensor
-
 def tensor_to_size(source, dest_size):
     if isinstance(dest_size, torch.Tensor):
         dest_size = dest_size.shape[0]
@@ -186,6 +326,68 @@ def tensor_to_size(source, dest_size):
     elif source_size > dest_size:
         source = source[:dest_size]
 
+def pulid_patch_keys():
+    # (block, id, index) of every SDXL cross attention and the module_key of its ID projections
+    patch_keys = []
+    number = 0
+    for id in [4,5,7,8]: # id of input_blocks that have cross attention
+        block_indices = range(2) if id in [4, 5] else range(10) # transformer_depth
+        for index in block_indices:
+            patch_keys.append((("input", id, index), str(number*2+1)))
+            number += 1
+    for id in range(6): # id of output_blocks that have cross attention
+        block_indices = range(2) if id in [3, 4, 5] else range(10) # transformer_depth
+        for index in block_indices:
+            patch_keys.append((("output", id, index), str(number*2+1)))
+            number += 1
+    for index in range(10):
+        patch_keys.append((("middle", 0, index), str(number*2+1)))
+        number += 1
+    return patch_keys
+
+# block selections for ApplyPulidAdvanced, in the block_weights syntax
+BLOCK_PRESETS = {
+    "all": "input, middle, output",
+    "output blocks only": "output",
+    "middle and output blocks": "middle, output",
+    "skip high-res input blocks": "input:7, input:8, middle, output",
+    "low-res blocks only": "input:7, input:8, middle, output:0, output:1, output:2",
+}
+
+# blocks at the highest resolution that has cross attention, the others are one level lower
+HIRES_BLOCKS = [("input", 4), ("input", 5), ("output", 3), ("output", 4), ("output", 5)]
+
+def parse_block_weights(spec):
+    # comma or newline separated "block[:id[:index]][=weight]" rules, e.g. "output:0=0.8, middle, input:8:3"
+    rules = []
+    for rule in spec.replace("\n", ",").split(","):
+        rule = rule.strip()
+        if not rule:
+            continue
+        target, _, weight = rule.partition("=")
+        parts = [part.strip() for part in target.split(":")]
+        if parts[0] not in ("input", "middle", "output") or len(parts) > 3:
+            raise Exception(f"pulid: invalid block rule '{rule}'")
+        try:
+            rules.append((parts[0], tuple(int(part) for part in parts[1:]), float(weight) if weight.strip() else 1.0))
+        except ValueError:
+            raise Exception(f"pulid: invalid block rule '{rule}'")
+    return rules
+
+def select_patch_keys(patch_keys, spec):
+    # keep the layers matched by a rule with the weight of the last matching rule, the
+    # layers that are not matched are not patched at all
+    rules = parse_block_weights(spec)
+    selected = []
+    for key, module_key in patch_keys:
+        block_weight = None
+        for block, ids, weight in rules:
+            if key[0] == block and key[1:1 + len(ids)] == ids:
+                block_weight = weight
+        if block_weight is not None:
+            selected.append((key, module_key, block_weight))
+    return selected
+
 def set_model_patch_replace(model, patch_kwargs, key):
     to = model.model_options["transformer_options"].copy()
     if "patches_replace" not in to:
@@ -200,15 +402,123 @@ def set_model_patch_replace(model, patch_kwargs, key):
     
     if key not in to["patches_replace"]["attn2"]:
         to["patches_replace"]["attn2"][key] = Attn2Replace(pulid_attention, **patch_kwargs)
-        model.model_options["transformer_options"] = to
     else:
+        # stack on a copy, the model this one was cloned from keeps its own callbacks
+        to["patches_replace"]["attn2"][key] = to["patches_replace"]["attn2"][key].clone()
         to["patches_replace"]["attn2"][key].add(pulid_attention, **patch_kwargs)
+    model.model_options["transformer_options"] = to
+
+class SigmaCache:
+    # every patched layer of a model evaluation receives the same sigmas tensor, so the
+    # device to host copy is done once per evaluation and shared by all the layers. The
+    # evaluation is also placed in the sampler's schedule: run is the sample_sigmas tensor
+    # of the sampling run and step the index of the schedule step the evaluation belongs to
+    def __init__(self):
+        self.sigmas = None
+        self.sigma = None
+        self.run = None
+        self.schedule = None
+        self.step = None
+
+    def get(self, extra_options):
+        if 'sigmas' not in extra_options:
+            return 999999999.9
+
+        sigmas = extra_options["sigmas"]
+        if sigmas is not self.sigmas:
+            self.sigmas = sigmas
+            self.sigma = sigmas.detach().cpu()[0].item()
+            self.update_step(extra_options.get("sample_sigmas"))
+        return self.sigma
+
+    def update_step(self, sample_sigmas):
+        if sample_sigmas is None:
+            self.run = self.schedule = self.step = None
+            return
+        if sample_sigmas is not self.run:
+            self.run = sample_sigmas
+            self.schedule = sample_sigmas.detach().cpu().tolist()
+        # an evaluation at schedule[i], or between schedule[i] and schedule[i + 1] like the extra
+        # evaluations of Heun/DPM2 type samplers, belongs to step i
+        tolerance = 1e-5 * abs(self.sigma)
+        self.step = max(sum(1 for sigma in self.schedule if sigma >= self.sigma - tolerance) - 1, 0)
+
+    def last_step(self):
+        # the schedule ends with the final sigma, the last evaluated step is the one before
+        return self.step >= len(self.schedule) - 2
+
+# upper bound for the deltas kept by the opt-in temporal reuse of one patched model
+DELTA_CACHE_MAX_MEMORY = 1024 * 1024 * 1024
+
+class DeltaCache:
+    # DeepCache style reuse of the PuLID delta of a layer across sampler steps. A delta is
+    # reused for cache_interval - 1 steps unless sigma moved by more than cache_threshold
+    # (relative) since it was computed. There is one cache per apply_pulid, shared by its
+    # layers, so it goes away with the patched model. Its entries belong to one sampling run:
+    # they are dropped when another run starts and at the last step of the schedule, so
+    # nothing is held once sampling ends. Deltas beyond max_memory are simply not kept
+    def __init__(self, max_memory=DELTA_CACHE_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.entries = {}
+        self.memory = 0
+        self.run = None
+        self.warned = False
+
+    def clear(self):
+        self.entries = {}
+        self.memory = 0
+
+    def sync(self):
+        # False when there's nothing to reuse or keep at this evaluation
+        if sigma_cache.run is None:
+            if not self.warned:
+                logging.warning("pulid: the sampler doesn't provide sample_sigmas, cache_interval is ignored")
+                self.warned = True
+            self.clear()
+            return False
+        if sigma_cache.run is not self.run:
+            self.clear()
+            self.run = sigma_cache.run
+        if sigma_cache.last_step():
+            self.clear()
+            self.run = None
+            return False
+        return True
+
+    def get(self, key, sigma, cache_interval=1, cache_threshold=0.0, **kwargs):
+        if cache_interval <= 1 or not self.sync() or key not in self.entries:
+            return None
+        delta, delta_sigma, delta_step = self.entries[key]
+        if sigma_cache.step - delta_step >= cache_interval:
+            return None
+        if cache_threshold > 0 and abs(sigma - delta_sigma) > cache_threshold * delta_sigma:
+            return None
+        return delta
+
+    def put(self, key, delta, sigma, cache_interval=1, **kwargs):
+        if cache_interval <= 1 or not self.sync():
+            return
+        if key in self.entries:
+            self.memory -= self.entries.pop(key)[0].nbytes
+        if self.memory + delta.nbytes > self.max_memory:
+            return
+        self.entries[key] = (delta, sigma, sigma_cache.step)
+        self.memory += delta.nbytes
+
+sigma_cache = SigmaCache()
 
 class Attn2Replace:
     def __init__(self, callback=None, **kwargs):
         self.callback = [callback]
         self.kwargs = [kwargs]
     
+    def clone(self):
+        patch = Attn2Replace.__new__(Attn2Replace)
+        patch.__dict__.update(self.__dict__)
+        patch.callback = self.callback.copy()
+        patch.kwargs = self.kwargs.copy()
+        return patch
+
     def add(self, callback, **kwargs):          
         self.callback.append(callback)
         self.kwargs.append(kwargs)
@@ -219,61 +529,258 @@ class Attn2Replace:
     def __call__(self, q, k, v, extra_options):
         dtype = q.dtype
         out = optimized_attention(q, k, v, extra_options["n_heads"])
-        sigma = extra_options["sigmas"].detach().cpu()[0].item() if 'sigmas' in extra_options else 999999999.9
+        sigma = sigma_cache.get(extra_options)
 
-        for i, callback in enumerate(self.callback):
-            if sigma <= self.kwargs[i]["sigma_start"] and sigma >= self.kwargs[i]["sigma_end"]:
-                out = out + callback(out, q, k, v, extra_options, **self.kwargs[i])
+        active = [i for i in range(len(self.callback)) if sigma <= self.kwargs[i]["sigma_start"] and sigma >= self.kwargs[i]["sigma_end"]]
+
+        # deltas still fresh in the opt-in temporal cache are reused as they are
+        layout = (id(self), tuple(extra_options["cond_or_uncond"]), tuple(q.shape))
+        compute = []
+        for i in active:
+            delta = self.kwargs[i]["delta_cache"].get(layout + (i,), sigma, **self.kwargs[i])
+            if delta is None:
+                compute.append(i)
+            else:
+                out = out + delta
+
+        # callbacks attending with the same view of the queries run together
+        views = {}
+        for i in compute:
+            views.setdefault(QueryView.key(**self.kwargs[i]), []).append(i)
+
+        for indices in views.values():
+            view = QueryView(q, out, extra_options, **self.kwargs[indices[0]])
+            if view.empty():
+                continue
+            if len(indices) > 1 and all(self.callback[i] is pulid_attention for i in indices):
+                deltas = pulid_attention_stacked(view.out, view.q, k, v, view.extra_options, [self.kwargs[i] for i in indices])
+            else:
+                deltas = []
+                view_out = view.out
+                for i in indices:
+                    deltas.append(self.callback[i](view_out, view.q, k, v, view.extra_options, **self.kwargs[i]))
+                    view_out = view_out + deltas[-1]
+
+            for i, delta in zip(indices, deltas):
+                delta = view.restore(delta)
+                self.kwargs[i]["delta_cache"].put(layout + (i,), delta, sigma, **self.kwargs[i])
+                out = out + delta
         
         return out.to(dtype=dtype)
 
-def pulid_attention(out, q, k, v, extra_options, module_key='', pulid=None, cond=None, uncond=None, weight=1.0, num_zero=8, ortho=False, ortho_v2=False, **kwargs):
-    k_key = module_key + "_to_k_ip"
-    v_key = module_key + "_to_v_ip"
+def token_grid(tokens, extra_options):
+    # (height, width) of the tokens of a layer, from its activations or from the latent
+    # size and the downsampling of the block
+    if "activations_shape" in extra_options:
+        grid = tuple(extra_options["activations_shape"][-2:])
+        if grid[0] * grid[1] == tokens:
+            return grid
+    height, width = extra_options["original_shape"][-2:]
+    for factor in (1, 2, 4, 8):
+        grid = (-(-height // factor), -(-width // factor))
+        if grid[0] * grid[1] == tokens:
+            return grid
+    return None
+
+def downsample_tokens(x, grid, factor):
+    b, n, c = x.shape
+    x = x.transpose(1, 2).reshape(b, c, *grid)
+    x = nn.functional.avg_pool2d(x, factor, ceil_mode=True)
+    return x.flatten(2).transpose(1, 2)
+
+def upsample_tokens(x, small_grid, grid):
+    b, n, c = x.shape
+    x = x.transpose(1, 2).reshape(b, c, *small_grid)
+    x = nn.functional.interpolate(x, size=grid, mode="bilinear", align_corners=False)
+    return x.flatten(2).transpose(1, 2)
+
+def mask_tokens(mask, grid, mask_cache, x):
+    # the tokens of a grid covered by the mask and the mask values there ([mask batch, tokens, 1]),
+    # the mask is area resized once per grid
+    key = (grid, str(x.device), x.dtype)
+    if key not in mask_cache:
+        mask = mask if mask.dim() == 3 else mask.unsqueeze(0)
+        mask = nn.functional.interpolate(mask.unsqueeze(1).to(device=x.device, dtype=torch.float32), size=grid, mode="area").flatten(1)
+        tokens = (mask.amax(dim=0) > 0).nonzero().flatten()
+        mask_cache[key] = (tokens, mask.index_select(1, tokens).unsqueeze(-1).to(dtype=x.dtype))
+    return mask_cache[key]
+
+class QueryView:
+    # the queries (and attention output) an adapter actually works on: average pooled by
+    # query_downsample on the spatial grid and only the tokens covered by attn_mask. The ID
+    # attention and the projection run on the view and restore() brings their delta back to
+    # the layer's tokens
+    @staticmethod
+    def key(query_downsample=1, attn_mask=None, **kwargs):
+        return (query_downsample, None if attn_mask is None else id(attn_mask))
+
+    def __init__(self, q, out, extra_options, query_downsample=1, attn_mask=None, mask_cache=None, **kwargs):
+        self.q = q
+        self.out = out
+        self.extra_options = extra_options
+        self.grid = None
+        self.tokens = None
+
+        if query_downsample > 1:
+            grid = token_grid(q.shape[1], extra_options)
+            if grid is not None and min(grid) >= query_downsample:
+                self.grid = grid
+                self.small_grid = (-(-grid[0] // query_downsample), -(-grid[1] // query_downsample))
+                self.q = downsample_tokens(self.q, grid, query_downsample)
+                self.out = downsample_tokens(self.out, grid, query_downsample)
+
+        if attn_mask is not None:
+            grid = self.small_grid if self.grid is not None else token_grid(q.shape[1], extra_options)
+            # a layer whose grid can't be recovered gets the ID attention everywhere
+            if grid is not None:
+                self.tokens, self.weights = mask_tokens(attn_mask, grid, mask_cache, self.q)
+                if self.weights.shape[0] > 1:
+                    # one mask per latent, latent j of every chunk gets mask j % masks. The weights
+                    # of the rows are gathered once per grid and batch layout
+                    batch_prompt = self.q.shape[0] // len(self.extra_options["cond_or_uncond"])
+                    layout = ("rows", grid, str(self.q.device), self.q.dtype, self.q.shape[0], batch_prompt)
+                    if layout not in mask_cache:
+                        latents = torch.tensor([(r % batch_prompt) % self.weights.shape[0] for r in range(self.q.shape[0])], dtype=torch.long, device=self.q.device)
+                        mask_cache[layout] = self.weights.index_select(0, latents)
+                    self.weights = mask_cache[layout]
+                self.view_tokens = self.q.shape[1]
+                self.q = self.q.index_select(1, self.tokens)
+                self.out = self.out.index_select(1, self.tokens)
+
+    def empty(self):
+        return self.q.shape[1] == 0
+
+    def restore(self, delta):
+        if self.tokens is not None:
+            delta = delta.new_zeros((delta.shape[0], self.view_tokens, delta.shape[2])).index_copy_(1, self.tokens, delta * self.weights)
+        if self.grid is not None:
+            delta = upsample_tokens(delta, self.small_grid, self.grid)
+        return delta
+
+# batch layouts kept per layer before the kv_cache of that layer is cleared
+KV_CACHE_LAYOUTS = 8
+
+def batch_kv(kv_cache, module_key, kv, cond_or_uncond, batch_prompt, dtype, identities=1):
+    # the batched keys/values only depend on the cond/uncond layout of the batch, they are
+    # gathered once per layout and reused by every following step. kv holds the identities
+    # rows then the uncond row, latent j of every cond chunk gets identity j % identities
+    layouts = kv_cache.setdefault(module_key, {})
+    layout = (tuple(cond_or_uncond), batch_prompt, dtype)
+    if layout not in layouts:
+        if len(layouts) >= KV_CACHE_LAYOUTS:
+            layouts.clear()
+        k, v = kv
+        rows = torch.tensor([j % identities if i == 0 else identities for i in cond_or_uncond for j in range(batch_prompt)], device=k.device)
+        layouts[layout] = (k.index_select(0, rows).to(dtype=dtype), v.index_select(0, rows).to(dtype=dtype))
+    return layouts[layout]
+
+def pulid_batch_kv(q, extra_options, module_key='', ip_kv=None, kv_cache=None, identities=1, **kwargs):
+    cond_or_uncond = extra_options["cond_or_uncond"]
+    batch_prompt = q.shape[0] // len(cond_or_uncond)
+
+    # keys and values of the ID tokens are projected once by apply_pulid, the cond rows of the
+    # identities first and the uncond row last
+    return batch_kv(kv_cache, module_key, ip_kv[module_key], cond_or_uncond, batch_prompt, q.dtype, identities)
+
+# timed runs of each backend when small_key_attention meets a new shape
+SMALL_KEY_BENCH_RUNS = 5
+
+# (device, dtype, q shape, key tokens, heads, num_zero) -> name of the fastest ID_ATTENTION_BACKENDS entry
+small_key_backend = {}
+
+# additive attention biases of zero_token_attention, per (num_zero, key tokens, device, dtype)
+zero_token_biases = {}
+
+def device_synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+def time_attention(fn, q, k, v, heads):
+    fn(q, k, v, heads)
+    device_synchronize(q.device)
+    start = time.perf_counter()
+    for _ in range(SMALL_KEY_BENCH_RUNS):
+        fn(q, k, v, heads)
+    device_synchronize(q.device)
+    return time.perf_counter() - start
+
+def zero_token_attention(q, k, v, heads, num_zero=0, biased=True):
+    # optimized_attention with num_zero implicit zero keys/values. biased appends one zero key/value
+    # and biases its logit by log(num_zero), so it weighs exp(log(num_zero)) = num_zero in every
+    # softmax denominator, exactly like num_zero zero keys. Otherwise the num_zero zero keys/values
+    # are appended, which keeps the kernels that don't take a mask
+    if num_zero == 0:
+        return optimized_attention(q, k, v, heads)
+    if not biased:
+        zeros = k.new_zeros((k.shape[0], num_zero, k.shape[2]))
+        return optimized_attention(q, torch.cat([k, zeros], dim=1), torch.cat([v, zeros], dim=1), heads)
+    key = (num_zero, k.shape[1], str(q.device), q.dtype)
+    if key not in zero_token_biases:
+        bias = torch.zeros((1, k.shape[1] + 1), dtype=q.dtype, device=q.device)
+        bias[0, -1] = float(np.log(num_zero))
+        zero_token_biases[key] = bias
+    zero = k.new_zeros((k.shape[0], 1, k.shape[2]))
+    return optimized_attention(q, torch.cat([k, zero], dim=1), torch.cat([v, zero], dim=1), heads, mask=zero_token_biases[key])
+
+# the exact ways to attend to the ID keys plus num_zero zero keys, (q, k, v, heads, num_zero) -> out
+ID_ATTENTION_BACKENDS = {
+    "id_attention": lambda q, k, v, heads, num_zero: id_attention(q, k, v, heads, num_zero=num_zero)[0],
+    "optimized_attention": lambda q, k, v, heads, num_zero: zero_token_attention(q, k, v, heads, num_zero, biased=False),
+    "optimized_attention with a biased zero key": lambda q, k, v, heads, num_zero: zero_token_attention(q, k, v, heads, num_zero),
+}
 
+def small_key_attention(q, k, v, heads, num_zero=0):
+    # with only a few dozen ID keys the generic kernel can spend more on setup and head reshaping
+    # than on the math. The first call of every shape times the backends and the fastest one is kept
+    key = (str(q.device), q.dtype, tuple(q.shape), k.shape[1], heads, num_zero)
+    if key not in small_key_backend:
+        names = list(ID_ATTENTION_BACKENDS) if num_zero > 0 else ["id_attention", "optimized_attention"]
+        times = {name: time_attention(lambda *args: ID_ATTENTION_BACKENDS[name](*args, num_zero), q, k, v, heads) for name in names}
+        small_key_backend[key] = min(times, key=times.get)
+        logging.info(f"pulid: {small_key_backend[key]} for q {tuple(q.shape)} and {k.shape[1]} ID tokens + {num_zero} zero tokens (" + ", ".join(f"{name} {t * 1000 / SMALL_KEY_BENCH_RUNS:.3f} ms" for name, t in times.items()) + ")")
+    return ID_ATTENTION_BACKENDS[small_key_backend[key]](q, k, v, heads, num_zero)
+
+def pulid_attention(out, q, k, v, extra_options, weight=1.0, ortho=False, ortho_v2=False, num_zero=0, **kwargs):
     dtype = q.dtype
-    cond_or_uncond = extra_options["cond_or_uncond"]
-    b = q.shape[0]
-    batch_prompt = b // len(cond_or_uncond)
-
-    #conds = torch.cat([uncond.repeat(batch_prompt, 1, 1), cond.repeat(batch_prompt, 1, 1)], dim=0)
-    #zero_tensor = torch.zeros((conds.size(0), num_zero, conds.size(-1)), dtype=conds.dtype, device=conds.device)
-    #conds = torch.cat([conds, zero_tensor], dim=1)
-    #ip_k = pulid.ip_layers.to_kvs[k_key](conds)
-    #ip_v = pulid.ip_layers.to_kvs[v_key](conds)
-    
-    if num_zero > 0:
-        zero_tensor = torch.zeros((cond.size(0), num_zero, cond.size(-1)), dtype=cond.dtype, device=cond.device)
-        cond = torch.cat([cond, zero_tensor], dim=1)
-        uncond = torch.cat([uncond, zero_tensor], dim=1)
-    k_cond = pulid.ip_layers.to_kvs[k_key](cond).repeat(batch_prompt, 1, 1)
-    k_uncond = pulid.ip_layers.to_kvs[k_key](uncond).repeat(batch_prompt, 1, 1)
-    v_cond = pulid.ip_layers.to_kvs[v_key](cond).repeat(batch_prompt, 1, 1)
-    v_uncond = pulid.ip_layers.to_kvs[v_key](uncond).repeat(batch_prompt, 1, 1)
-    ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0)
-    ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0)
-
-    out_ip = optimized_attention(q, ip_k, ip_v, extra_options["n_heads"])
-    
+    ip_k, ip_v = pulid_batch_kv(q, extra_options, **kwargs)
+
+    attn_mean = None
+    if ortho_v2:
+        # the attention mass on the first 5 ID tokens comes out of the same pass
+        out_ip, attn_mean = id_attention(q, ip_k, ip_v, extra_options["n_heads"], mass_tokens=5, num_zero=num_zero)
+    else:
+        out_ip = small_key_attention(q, ip_k, ip_v, extra_options["n_heads"], num_zero)
+
+    return pulid_projection(out, out_ip, attn_mean, weight, ortho, ortho_v2).to(dtype=dtype)
+
+def pulid_attention_stacked(out, q, k, v, extra_options, adapters):
+    # several PuLID adapters on the same layer attend with the same q, so their ID attention
+    # runs as one launch with a softmax per adapter. The projections are then done in order,
+    # as the chained callbacks would, each one seeing the output of the previous ones.
+    # Returns the delta of every adapter
+    dtype = q.dtype
+    kvs = [pulid_batch_kv(q, extra_options, **kwargs) for kwargs in adapters]
+    # the attention mass is only read by fidelity (ortho_v2)
+    mass_tokens = 5 if any(kwargs.get("ortho_v2", False) for kwargs in adapters) else 0
+    out_ips, attn_means = stacked_id_attention(q, [ip_k for ip_k, _ in kvs], [ip_v for _, ip_v in kvs], extra_options["n_heads"], mass_tokens=mass_tokens, num_zero=[kwargs.get("num_zero", 0) for kwargs in adapters])
+    if attn_means is None:
+        attn_means = [None] * len(adapters)
+
+    deltas = []
+    for kwargs, out_ip, attn_mean in zip(adapters, out_ips, attn_means):
+        deltas.append(pulid_projection(out, out_ip, attn_mean, kwargs.get("weight", 1.0), kwargs.get("ortho", False), kwargs.get("ortho_v2", False)).to(dtype=dtype))
+        out = out + deltas[-1]
+    return deltas
+
+def pulid_projection(out, out_ip, attn_mean, weight, ortho, ortho_v2):
     if ortho:
-        out = out.to(dtype=torch.float32)
-        out_ip = out_ip.to(dtype=torch.float32)
-        projection = (torch.sum((out * out_ip), dim=-2, keepdim=True) / torch.sum((out * out), dim=-2, keepdim=True) * out)
-        orthogonal = out_ip - projection
-        out = weight * orthogonal
+        return orthogonal_projection(out, out_ip, weight)
     elif ortho_v2:
-        out = out.to(dtype=torch.float32)
-        out_ip = out_ip.to(dtype=torch.float32)
-        attn_map = q @ ip_k.transpose(-2, -1)
-        attn_mean = attn_map.softmax(dim=-1).mean(dim=1, keepdim=True)
-        attn_mean = attn_mean[:, :, :5].sum(dim=-1, keepdim=True)
-        projection = (torch.sum((out * out_ip), dim=-2, keepdim=True) / torch.sum((out * out), dim=-2, keepdim=True) * out)
-        orthogonal = out_ip + (attn_mean - 1) * projection
-        out = weight * orthogonal
+        return orthogonal_projection(out, out_ip, weight, scale=attn_mean)
     else:
-        out = out_ip * weight
-
-    return out.to(dtype=dtype)
+        return out_ip * weight
 
 def to_gray(img):
     x = 0.299 * img[:, 0:1] + 0.587 * img[:, 1:2] + 0.114 * img[:, 2:3]
@@ -289,13 +796,14 @@ def to_gray(img):
 class PulidModelLoader:
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": { "pulid_file": (folder_paths.get_filename_list("pulid"), )}}
+        return {"required": { "pulid_file": (folder_paths.get_filename_list("pulid"), ),
+                              "weight_format": (["default", "int8"], )}}
 
     RETURN_TYPES = ("PULID",)
     FUNCTION = "load_model"
     CATEGORY = "pulid"
 
-    def load_model(self, pulid_file):
+    def load_model(self, pulid_file, weight_format="default"):
         ckpt_path = folder_paths.get_full_path("pulid", pulid_file)
 
         model = comfy.utils.load_torch_file(ckpt_path, safe_load=True)
@@ -309,6 +817,12 @@ class PulidModelLoader:
                     st_model["ip_adapter"][key.replace("ip_adapter.", "")] = model[key]
             model = st_model
 
+        if weight_format == "int8":
+            # the ID key/value projections are kept as int8 with a per output channel scale
+            model["ip_adapter"] = quantize_int8(model["ip_adapter"])
+
+        model["fingerprint"] = file_fingerprint(ckpt_path)
+
         return (model,)
 
 class PulidInsightFaceLoader:
@@ -368,6 +882,25 @@ class PulidEvaClipLoader:
         return (model,)
 
 
+def patch_memory(patch_kwargs):
+    # bytes held by the tensors the patches of one apply_pulid share: the ID keys/values, the
+    # keys/values gathered per batch layout and the reused deltas (filled while sampling) and
+    # the attention mask
+    tensors = []
+    for k, v in patch_kwargs["ip_kv"].values():
+        tensors += [k, v]
+    for layouts in patch_kwargs["kv_cache"].values():
+        for k, v in layouts.values():
+            tensors += [k, v]
+    for value in patch_kwargs["mask_cache"].values():
+        tensors += list(value) if isinstance(value, tuple) else [value]
+    for delta, _, _ in patch_kwargs["delta_cache"].entries.values():
+        tensors.append(delta)
+    if patch_kwargs["attn_mask"] is not None:
+        tensors.append(patch_kwargs["attn_mask"])
+    storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for t in tensors}
+    return sum(storages.values())
+
 class ApplyPulid:
     @classmethod
     def INPUT_TYPES(s):
@@ -390,7 +923,120 @@ class ApplyPulid:
     FUNCTION = "apply_pulid"
     CATEGORY = "pulid"
 
-    def apply_pulid(self, model, pulid, eva_clip, face_analysis, image, method, weight, start_at, end_at):
+    def encode_faces(self, pulid_model, eva_clip, face_helper, image, iface_embeds, landmarks, device, dtype):
+        bg_label = [0, 16, 18, 7, 8, 9, 14, 15]
+
+        # crop, parse and encode the aligned faces in one batch
+        iface_embeds = torch.stack(iface_embeds).to(device, dtype=dtype)
+        face = warp_faces(image.to(device), landmarks, face_helper.face_template, face_helper.face_size)
+
+        parsing_out = face_helper.face_parse(T.functional.normalize(face, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]))[0]
+        parsing_out = parsing_out.argmax(dim=1, keepdim=True)
+        bg = sum(parsing_out == i for i in bg_label).bool()
+        white_image = torch.ones_like(face)
+        face_features_image = torch.where(bg, white_image, to_gray(face))
+        face_features_image = T.functional.resize(face_features_image, eva_clip.image_size, T.InterpolationMode.BICUBIC).to(device, dtype=dtype)
+        face_features_image = T.functional.normalize(face_features_image, eva_clip.image_mean, eva_clip.image_std)
+
+        id_cond_vit, id_vit_hidden = eva_clip(face_features_image, return_all_features=False, return_hidden=True, shuffle=False)
+        id_cond_vit = id_cond_vit.to(device, dtype=dtype)
+        for idx in range(len(id_vit_hidden)):
+            id_vit_hidden[idx] = id_vit_hidden[idx].to(device, dtype=dtype)
+
+        id_cond_vit = torch.div(id_cond_vit, torch.norm(id_cond_vit, 2, 1, True))
+
+        # combine embeddings
+        id_cond = torch.cat([iface_embeds, id_cond_vit], dim=-1)
+        cond = pulid_model.get_image_embeds(id_cond, id_vit_hidden)
+        uncond = pulid_model.get_uncond_embeds(id_cond, id_vit_hidden)
+
+        return cond, uncond
+
+    def get_id_embeds(self, pulid_model, eva_clip, face_analysis, image, device, dtype, alignment="retinaface", per_image=False):
+        eva_clip.to(device, dtype=dtype)
+
+        face_helper = ModifiedFaceRestoreHelper( 
+            dirpath=dir_facedetection_models,
+            device=device,
+        )
+
+        # references are streamed in micro-batches sized to the free memory, only a
+        # running sum of the embeddings is kept so peak memory doesn't grow with the references.
+        # With per_image every reference is its own identity and its embeddings are kept
+        num_images = image.shape[0]
+        batch_size = encode_batch_size(device)
+        cond_sum = None
+        cond_rows = []
+        uncond = None
+
+        # insightface (onnxruntime, often on CPU) runs ahead in a worker thread while
+        # the previous faces are aligned and encoded on the torch device
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            # up to batch_size detections are queued ahead of the faces being encoded
+            detections = deque(executor.submit(detect_face_image, face_analysis, image[i]) for i in range(min(batch_size, num_images)))
+            next_image = len(detections)
+            end = 0
+
+            while end < num_images:
+                start = end
+
+                # wait for the oldest detection only and take the ones that are already done with it,
+                # so the first face is encoded while insightface works on the next one and the
+                # micro-batches grow up to batch_size when detection runs ahead of the encoders
+                faces = [detections.popleft().result()]
+                while detections and detections[0].done() and len(faces) < batch_size:
+                    faces.append(detections.popleft().result())
+                end = start + len(faces)
+
+                # refill the queue before encoding so the worker never waits on the encoders
+                while next_image < min(end + batch_size, num_images):
+                    detections.append(executor.submit(detect_face_image, face_analysis, image[next_image]))
+                    next_image += 1
+
+                iface_embeds = []
+                landmarks = []
+                for i, (face, det_size, image_np) in enumerate(faces, start):
+                    # get insightface embeddings
+                    if face is None:
+                        raise Exception('insightface: No face detected.')
+                    logging.info(f"pulid: insightface found the face in image {i} at det size {det_size}")
+                    iface_embeds.append(torch.from_numpy(face.embedding))
+
+                    # landmarks to align the face for eva_clip
+                    if alignment == "insightface":
+                        # warp the same face insightface picked, no second detector. insightface ran
+                        # on image_np, so the kps are already in the coordinates warp_faces samples
+                        landmarks.append(face.kps)
+                    else:
+                        face_helper.clean_all()
+                        face_helper.read_image(image_np)
+                        face_helper.get_face_landmarks_5(only_center_face=True)
+
+                        if len(face_helper.all_landmarks_5) == 0:
+                            raise Exception('facexlib: No face detected.')
+                        # read_image upscales references under 512px, bring the landmarks back to
+                        # the coordinates of the image warp_faces samples
+                        landmarks.append(rescale_landmarks(face_helper.all_landmarks_5[0], face_helper.input_img.shape, image_np.shape))
+
+                cond, uncond = self.encode_faces(pulid_model, eva_clip, face_helper, image[start:end], iface_embeds, landmarks, device, dtype)
+                if per_image:
+                    cond_rows.append(cond)
+                    continue
+                cond = cond.to(torch.float32).sum(dim=0, keepdim=True)
+                cond_sum = cond if cond_sum is None else cond_sum + cond
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        if per_image:
+            return torch.cat(cond_rows), uncond
+
+        # average embeddings
+        cond = (cond_sum / num_images).to(dtype=dtype)
+
+        return cond, uncond
+
+    def apply_pulid(self, model, pulid, eva_clip, face_analysis, image, method, weight, start_at, end_at, alignment="retinaface", blocks="all", cache_interval=1, cache_threshold=0.0, hires_query_downsample=1, lowres_query_downsample=1, identity="average", block_weights="", attn_mask=None):
         work_model = model.clone()
         
         device = comfy.model_management.get_torch_device()
@@ -398,9 +1044,6 @@ class ApplyPulid:
         if dtype not in [torch.float32, torch.float16, torch.bfloat16]:
             dtype = torch.float16 if comfy.model_management.should_use_fp16() else torch.float32
 
-        eva_clip.to(device, dtype=dtype)
-        pulid_model = PulidModel(pulid).to(device, dtype=dtype)
-
         if method == "fidelity":
             num_zero = 8
             ortho = False
@@ -414,118 +1057,94 @@ class ApplyPulid:
             ortho = False
             ortho_v2 = False
 
-        #face_analysis.det_model.input_size = (640,640)
-        image = tensor_to_image(image)
-
-        face_helper = ModifiedFaceRestoreHelper( 
-            dirpath=dir_facedetection_models,
-            device=device,
-        )
-
- 
-        bg_label = [0, 16, 18, 7, 8, 9, 14, 15]
-        cond = []
-        uncond = []
-
-        for i in range(image.shape[0]):
-            # get insightface embeddings
-            iface_embeds = None
-            for size in [(size, size) for size in range(640, 256, -64)]:
-                face_analysis.det_model.input_size = size
-                face = face_analysis.get(image[i])
-                if face:
-                    face = sorted(face, key=lambda x: (x.bbox[2] - x.bbox[0]) * (x.bbox[3] - x.bbox[1]), reverse=True)[-1]
-                    iface_embeds = torch.from_numpy(face.embedding).unsqueeze(0).to(device, dtype=dtype)
-                    break
-            else:
-                raise Exception('insightface: No face detected.')
-
-            # get eva_clip embeddings
-            face_helper.clean_all()
-            face_helper.read_image(image[i])
-            face_helper.get_face_landmarks_5(only_center_face=True)
-            face_helper.align_warp_face()
-
-            if len(face_helper.cropped_faces) == 0:
-                raise Exception('facexlib: No face detected.')
-            
-            face = face_helper.cropped_faces[0]
-            face = image_to_tensor(face).unsqueeze(0).permute(0,3,1,2).to(device)
-
-
-            parsing_out = face_helper.face_parse(T.functional.normalize(face, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]))[0]
-            parsing_out = parsing_out.argmax(dim=1, keepdim=True)
-            bg = sum(parsing_out == i for i in bg_label).bool()
-            white_image = torch.ones_like(face)
-            face_features_image = torch.where(bg, white_image, to_gray(face))
-            face_features_image = T.functional.resize(face_features_image, eva_clip.image_size, T.InterpolationMode.BICUBIC).to(device, dtype=dtype)
-            face_features_image = T.functional.normalize(face_features_image, eva_clip.image_mean, eva_clip.image_std)
-            
-
-            id_cond_vit, id_vit_hidden = eva_clip(face_features_image, return_all_features=False, return_hidden=True, shuffle=False)
-            id_cond_vit = id_cond_vit.to(device, dtype=dtype)
-            for idx in range(len(id_vit_hidden)):
-                id_vit_hidden[idx] = id_vit_hidden[idx].to(device, dtype=dtype)
-
-            id_cond_vit = torch.div(id_cond_vit, torch.norm(id_cond_vit, 2, 1, True))
-
-            # combine embeddings
-            id_cond = torch.cat([iface_embeds, id_cond_vit], dim=-1)
-            id_uncond = torch.zeros_like(id_cond)
-            id_vit_hidden_uncond = []
-            for idx in range(len(id_vit_hidden)):
-                id_vit_hidden_uncond.append(torch.zeros_like(id_vit_hidden[idx]))
-            
-            cond.append(pulid_model.get_image_embeds(id_cond, id_vit_hidden))
-            uncond.append(pulid_model.get_image_embeds(id_uncond, id_vit_hidden_uncond))
-        
-        # average embeddings
-        cond = torch.cat(cond).to(device, dtype=dtype)
-        uncond = torch.cat(uncond).to(device, dtype=dtype)
+        # a repeated identity skips the whole face pipeline
+        cache_key = None
+        if "fingerprint" in pulid:
+            cache_key = EmbedsCache.make_key(image_fingerprint(image), pulid["fingerprint"], dtype, alignment, identity)
+        embeds = embeds_cache.get(cache_key) if cache_key is not None else None
+
+        # only lives for the duration of apply_pulid, the patches keep the projected ID keys/values
+        pulid_model = PulidModel(pulid, id_encoder=embeds is None).to(device, dtype=dtype)
+
+        if embeds is None:
+            try:
+                cond, uncond = self.get_id_embeds(pulid_model, eva_clip, face_analysis, image, device, dtype, alignment, per_image=identity == "per image")
+            finally:
+                # eva_clip is not needed while sampling, give its VRAM back to the unet
+                eva_clip.to(comfy.model_management.unet_offload_device())
+            if cache_key is not None:
+                embeds_cache.put(cache_key, cond, uncond)
+        else:
+            cond, uncond = embeds
+        cond = cond.to(device, dtype=dtype)
+        uncond = uncond.to(device, dtype=dtype)
         if cond.shape[0] > 1:
-            cond = torch.mean(cond, dim=0, keepdim=True)
-            uncond = torch.mean(uncond, dim=0, keepdim=True)
+            logging.info(f"pulid: {cond.shape[0]} identities, latent i of the batch gets identity i % {cond.shape[0]}")
 
         sigma_start = work_model.get_model_object("model_sampling").percent_to_sigma(start_at)
         sigma_end = work_model.get_model_object("model_sampling").percent_to_sigma(end_at)
 
+        # block_weights, when given, replaces the preset
+        patch_keys = select_patch_keys(pulid_patch_keys(), block_weights if block_weights.strip() else BLOCK_PRESETS[blocks])
+
+        # cond and uncond are fixed from here on, project the ID keys/values of every patched layer once
+        # the num_zero zero tokens of fidelity/style project to zero keys and values (to_k/to_v have
+        # no bias), they are accounted for in the ID attention softmax instead of being concatenated
+        embeds = torch.cat([cond, uncond])
+        ip_kv = pulid_model.ip_layers(embeds, [module_key for _, module_key, _ in patch_keys])
+        del pulid_model, embeds
+        comfy.model_management.soft_empty_cache()
+
         patch_kwargs = {
-            "pulid": pulid_model,
+            "ip_kv": ip_kv,
+            "kv_cache": {},
             "weight": weight,
-            "cond": cond,
-            "uncond": uncond,
             "sigma_start": sigma_start,
             "sigma_end": sigma_end,
-            "num_zero": num_zero,
             "ortho": ortho,
             "ortho_v2": ortho_v2,
+            "num_zero": num_zero,
+            "identities": cond.shape[0],
+            "attn_mask": attn_mask,
+            "mask_cache": {},
+            "cache_interval": cache_interval,
+            "cache_threshold": cache_threshold,
+            "delta_cache": DeltaCache(),
         }
 
-        number = 0
-        for id in [4,5,7,8]: # id of input_blocks that have cross attention
-            block_indices = range(2) if id in [4, 5] else range(10) # transformer_depth
-            for index in block_indices:
-                patch_kwargs["module_key"] = str(number*2+1)
-                set_model_patch_replace(work_model, patch_kwargs, ("input", id, index))
-                number += 1
-        for id in range(6): # id of output_blocks that have cross attention
-            block_indices = range(2) if id in [3, 4, 5] else range(10) # transformer_depth
-            for index in block_indices:
-                patch_kwargs["module_key"] = str(number*2+1)
-                set_model_patch_replace(work_model, patch_kwargs, ("output", id, index))
-                number += 1
-        for index in range(10):
-            patch_kwargs["module_key"] = str(number*2+1)
-            set_model_patch_replace(work_model, patch_kwargs, ("middle", 0, index))
-            number += 1
+        for key, module_key, block_weight in patch_keys:
+            patch_kwargs["module_key"] = module_key
+            patch_kwargs["weight"] = weight * block_weight
+            patch_kwargs["query_downsample"] = hires_query_downsample if key[:2] in HIRES_BLOCKS else lowres_query_downsample
+            set_model_patch_replace(work_model, patch_kwargs, key)
+
+        logging.info(f"pulid: {len(patch_keys)} layers patched, {patch_memory(patch_kwargs) / 2**20:.1f} MiB retained by the patch")
 
         return (work_model,)
 
+class ApplyPulidAdvanced(ApplyPulid):
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = super().INPUT_TYPES()
+        inputs["required"]["alignment"] = (["retinaface", "insightface"],)
+        inputs["required"]["blocks"] = (list(BLOCK_PRESETS.keys()),)
+        inputs["required"]["cache_interval"] = ("INT", {"default": 1, "min": 1, "max": 100 })
+        inputs["required"]["cache_threshold"] = ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01 })
+        inputs["required"]["hires_query_downsample"] = ("INT", {"default": 1, "min": 1, "max": 8 })
+        inputs["required"]["lowres_query_downsample"] = ("INT", {"default": 1, "min": 1, "max": 8 })
+        inputs["required"]["identity"] = (["average", "per image"],)
+        inputs["optional"] = {
+            "block_weights": ("STRING", {"default": "", "multiline": True}),
+            "attn_mask": ("MASK",),
+        }
+        return inputs
+
 NODE_CLASS_MAPPINGS = {
     "PulidModelLoader": PulidModelLoader,
     "PulidInsightFaceLoader": PulidInsightFaceLoader,
     "PulidEvaClipLoader": PulidEvaClipLoader,
     "ApplyPulid": ApplyPulid,
+    "ApplyPulidAdvanced": ApplyPulidAdvanced,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -533,4 +1152,5 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "PulidInsightFaceLoader": "Load InsightFace",
     "PulidEvaClipLoader": "Load Eva Clip",
     "ApplyPulid": "Apply Pulid",
+    "ApplyPulidAdvanced": "Apply Pulid Advanced",
 }
\ No newline at end of file